@@ -3,35 +3,93 @@
 import os
 import json
 from datetime import timedelta, datetime
-from typing import Annotated, Optional
+from typing import Annotated, Literal, Optional
 
 import msgpack
+import orjson
 
-from fastapi import Body, Depends, FastAPI, HTTPException, File
-from fastapi.responses import StreamingResponse, Response, FileResponse
+from fastapi import BackgroundTasks, Body, Depends, FastAPI, HTTPException, File, Request, status
+from fastapi.responses import ORJSONResponse, StreamingResponse, Response, FileResponse
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import OAuth2PasswordRequestForm
+from sqlalchemy import bindparam, delete, update
+from sqlalchemy.orm import defer
 from sqlmodel import Session, select
 
 from app.auth import auth_handler
 from app.auth import crypto
 from app import model, model_helpers, fit_parsing
 
-app_obj = FastAPI()
+# Statements are built once at import time; requests only bind parameters.
+LIST_ACTIVITIES_STMT = select(*model_helpers.ACTIVITY_BASE_COLUMNS).where(
+    model.ActivityTable.owner_id == bindparam("owner_id")).order_by(
+        model.ActivityTable.date.desc(),
+        model.ActivityTable.activity_id.desc()).limit(bindparam("limit"))
+# Fetch items older than the cursor date, or same date but smaller ID
+# (IDs are ULIDs, which sort lexicographically).
+LIST_ACTIVITIES_AFTER_CURSOR_STMT = LIST_ACTIVITIES_STMT.where(
+    (model.ActivityTable.date < bindparam("cursor_date")) |
+    ((model.ActivityTable.date == bindparam("cursor_date")) &
+     (model.ActivityTable.activity_id < bindparam("cursor_id"))))
+DELETE_ACTIVITY_STMT = delete(model.ActivityTable).where(
+    model.ActivityTable.activity_id == bindparam("activity_id"))
+
+TOKEN_TIMEOUT = timedelta(minutes=int(os.getenv("TOKEN_TIMEOUT", "30")))
+
+app_obj = FastAPI(default_response_class=ORJSONResponse)
 app_obj.add_middleware(
     CORSMiddleware,
     allow_origins=['*'],
     allow_credentials=True,  # Set to True if cookies are needed
     allow_methods=["*"],  # Allow all methods (GET, POST, etc.)
     allow_headers=["*"],  # Allow all headers
+    expose_headers=["Retry-After", "Location"],  # Read when polling for maps
 )
 
 
+def token_response(access_token: str):
+    """Returns a bearer token response, encoded directly with orjson."""
+    return Response(
+        content=orjson.dumps({"access_token": access_token, "token_type": "bearer"}),
+        media_type="application/json")
+
+
+def msgpack_default(obj):
+    """Encodes datetimes as ISO strings, as in the JSON responses."""
+    if isinstance(obj, datetime):
+        return obj.isoformat()
+    raise TypeError(f"Cannot serialize {type(obj)}")
+
+
+def negotiated_response(payload, request: Request):
+    """
+    Encodes `payload` as msgpack if the client accepts it, else as JSON.
+
+    Args:
+        payload: JSON-like data (dicts, lists, strings, numbers, datetimes).
+        request: The incoming request, whose Accept header is inspected.
+
+    Returns:
+        A `Response` with either `application/x-msgpack` or
+        `application/json` content.
+    """
+    headers = {"Vary": "Accept"}
+    if "application/x-msgpack" in request.headers.get("accept", ""):
+        return Response(
+            content=msgpack.packb(payload, use_bin_type=True, default=msgpack_default),
+            media_type="application/x-msgpack",
+            headers=headers)
+    return Response(
+        content=orjson.dumps(payload),
+        media_type="application/json",
+        headers=headers)
+
+
 # route handlers
 
 
-@app_obj.post("/token")
-async def login(
+@app_obj.post("/token", response_model=model.Token)
+def login(
         form_data: Annotated[OAuth2PasswordRequestForm, Depends()],
         session: Session = Depends(model_helpers.get_db_session)):
     """
@@ -54,7 +112,7 @@ async def login(
         HTTPException: If the username or password is incorrect (400 Bad Request).
 
     Returns:
-        A `model.Token` object containing the access token and token type.
+        The access token and token type, in the shape of `model.Token`.
     """
     user = model.UserLogin(email=form_data.username,
                         password=form_data.password)
@@ -62,13 +120,12 @@ async def login(
     if not db_user:
         raise HTTPException(
             status_code=400, detail="Incorrect username or password")
-    time_out = int(os.getenv("TOKEN_TIMEOUT")) or 30
-    token = auth_handler.create_access_token(db_user, timedelta(minutes=time_out))
-    return model.Token(access_token=token, token_type="bearer")
+    token = auth_handler.create_access_token(db_user, TOKEN_TIMEOUT)
+    return token_response(token)
 
 
 @app_obj.post("/upload_activity", response_model=model.ActivityBase)
-async def upload_activity(
+def upload_activity(
     *,
     session: Session = Depends(model_helpers.get_db_session),
     current_user_id: model.UserId = Depends(auth_handler.get_current_user_id),
@@ -76,7 +133,7 @@ async def upload_activity(
     ride_df = fit_parsing.extract_data_to_dataframe(file)
     summary = model_helpers.compute_activity_summary(ride_df=ride_df)
     activity_db = model.ActivityTable(
-        activity_id=crypto.generate_random_base64_string(16),
+        activity_id=crypto.generate_ulid(),
         name="Ride",
         owner_id=current_user_id.id,
         distance=summary.distance,
@@ -88,83 +145,108 @@ async def upload_activity(
     )
     session.add(activity_db)
     session.commit()
-    session.refresh(activity_db)
     return activity_db
 
 @app_obj.get("/activity/{activity_id}", response_model=model.ActivityResponse)
-async def get_activity(
+def get_activity(
     *,
+    request: Request,
     session: Session = Depends(model_helpers.get_db_session),
     activity_id: str):
-    q = select(model.ActivityTable).where(
-        model.ActivityTable.activity_id == activity_id)
-    activity = session.exec(q).first()
+    activity = session.get(
+        model.ActivityTable, activity_id,
+        options=[defer(model.ActivityTable.static_map)])
     if not activity:
         raise HTTPException(status_code=404, detail="Activity not found")
     activity_response = model_helpers.get_activity_response(activity, include_raw_data=False)
-    return activity_response
+    return negotiated_response(activity_response.model_dump(mode="json"), request)
 
 @app_obj.get("/activity_map/{activity_id}")
-async def get_activity_map(
+def get_activity_map(
     *,
     session: Session = Depends(model_helpers.get_db_session),
+    background_tasks: BackgroundTasks,
     activity_id: str):
-    activity = model_helpers.fetch_activity(activity_id, session)
-    if not activity.static_map:
-        activity_df = model_helpers.get_activity_df(activity)
-        activity.static_map = model_helpers.get_activity_map(ride_df=activity_df, num_samples=200)
-        if not activity.static_map:
-            raise HTTPException(status_code=404, detail="GPS data not available")
-        # Save the map for a future call
-        session.add(activity)
-        session.commit()
-    return Response(activity.static_map, media_type="image/png")
+    """
+    Returns the static map of an activity as a PNG.
+
+    Maps are rendered in the background. If it is not ready yet, this
+    returns 202 Accepted with a Retry-After header. If the last render
+    failed, this returns 503 until the retry backoff has passed.
+    """
+    # Clients poll this while the map renders: only load the data blob if
+    # the position columns are not in the dataframe cache.
+    activity = session.get(
+        model.ActivityTable, activity_id,
+        options=[defer(model.ActivityTable.data)])
+    if not activity:
+        raise HTTPException(status_code=404, detail="Activity not found")
+    if activity.static_map:
+        return Response(activity.static_map, media_type="image/png")
+    activity_df = model_helpers.get_activity_df(
+        activity, columns=["position_lat", "position_long"])
+    if not model_helpers.has_gps_points(activity_df):
+        raise HTTPException(status_code=404, detail="GPS data not available")
+    retry_after = model_helpers.activity_map_retry_after(activity_id)
+    if retry_after is not None:
+        raise HTTPException(
+            status_code=503, detail="Map rendering failed",
+            headers={"Retry-After": str(retry_after)})
+    model_helpers.schedule_activity_map(activity_id, background_tasks)
+    return Response(
+        status_code=202,
+        headers={"Retry-After": "2", "Location": f"/activity_map/{activity_id}"})
 
 @app_obj.get("/activity/{activity_id}/gpx")
-async def get_activity_gpx_route(
+def get_activity_gpx_route(
     *,
     session: Session = Depends(model_helpers.get_db_session),
     activity_id: str):
     activity = model_helpers.fetch_activity(activity_id, session)
-    activity_df = model_helpers.get_activity_df(activity)
+    activity_df = model_helpers.get_activity_df(
+        activity, columns=["position_lat", "position_long"])
     gpx_content = model_helpers.get_activity_gpx(activity_df)
-
-    def iterfile():
-        yield gpx_content
-
     return StreamingResponse(
-        iterfile(),
+        gpx_content,
         media_type="application/gpx+xml",
         headers={"Content-Disposition": f"attachment; filename={activity_id}.gpx"}
     )
 
 @app_obj.get("/activity/{activity_id}/raw")
-async def get_activity_raw_columns(
+def get_activity_raw_columns(
     *,
     session: Session = Depends(model_helpers.get_db_session),
     activity_id: str,
-    columns: str = None):
-    activity_df = model_helpers.fetch_activity_df(activity_id, session)
-    activity_dict = activity_df.to_dict(orient="list")
+    columns: str = None,
+    encoding: Literal["list", "ndarray"] = "list"):
+    """
+    Returns raw activity columns packed with msgpack.
+
+    With `encoding=ndarray`, numeric columns are sent as msgpack ExtType
+    arrays (see `model_helpers.pack_ndarray`) instead of lists of floats.
+    """
     if columns:
         column_list = columns.split(",")
     else:
         column_list = [
             "timestamp", "power", "distance", "speed", "altitude",
             "position_lat", "position_long"]
-    available_cols = set(activity_df.columns)
-    activity_dict = {col: activity_dict[col] for col in column_list if col in available_cols}
-    serialized_data = msgpack.packb(activity_dict)
-    
-    # Create a streaming response
-    def generate_data():
-        yield serialized_data
-
-    return StreamingResponse(generate_data(), media_type="application/x-msgpack")
+    activity_df = model_helpers.fetch_activity_df(
+        activity_id, session, columns=column_list)
+    activity_dict = {}
+    for col in activity_df.columns:
+        values = activity_df[col].to_numpy()
+        if encoding == "ndarray" and values.dtype.kind in "biuf":
+            activity_dict[col] = model_helpers.pack_ndarray(values)
+        else:
+            activity_dict[col] = values.tolist()
+    serialized_data = msgpack.packb(activity_dict, use_bin_type=True)
+    return Response(serialized_data, media_type="application/x-msgpack")
 
 @app_obj.get("/activities", response_model=list[model.ActivityBase])
-async def get_activities(
+def get_activities(
     *,
+    request: Request,
     session: Session = Depends(model_helpers.get_db_session),
     current_user_id: model.UserId = Depends(auth_handler.get_current_user_id),
     limit: int = 10, # Default limit
@@ -175,68 +257,56 @@ async def get_activities(
     Fetches a list of activities for the current user, sorted by date descending.
     Uses keyset (cursor-based) pagination for efficient loading.
     """
-    q = select(model.ActivityTable).where(
-        model.ActivityTable.owner_id == current_user_id.id)
-
+    params = {"owner_id": current_user_id.id, "limit": limit}
     # Apply cursor conditions if provided (for subsequent pages)
     if cursor_date is not None and cursor_id is not None:
-        # Fetch items older than the cursor date, or same date but smaller ID (since ID is random string, comparison works)
-        # Note: Adjust comparison (< or >) based on desired sort order (DESC vs ASC)
-        q = q.where(
-            (model.ActivityTable.date < cursor_date) |
-            ((model.ActivityTable.date == cursor_date) & (model.ActivityTable.activity_id < cursor_id))
-        )
-
-    # Always apply sorting and limit
-    q = q.order_by(model.ActivityTable.date.desc(), model.ActivityTable.activity_id.desc()).limit(limit)
+        q = LIST_ACTIVITIES_AFTER_CURSOR_STMT
+        params.update(cursor_date=cursor_date, cursor_id=cursor_id)
+    else:
+        q = LIST_ACTIVITIES_STMT
 
-    results = session.exec(q).all()
-    return results
+    # The projected rows already have the ActivityBase fields, so they go
+    # straight to orjson without Pydantic models or jsonable_encoder.
+    results = session.execute(q, params).all()
+    return negotiated_response([row._asdict() for row in results], request)
 
 @app_obj.patch("/activity/{activity_id}", response_model=model.ActivityBase)
-async def update_activity(
+def update_activity(
     *,
     session: Session = Depends(model_helpers.get_db_session),
     current_user_id: model.UserId = Depends(auth_handler.get_current_user_id),
     activity_id: str,
     activity_update: model.ActivityUpdate = Body(...)):
 
-    q = select(model.ActivityTable).where(model.ActivityTable.activity_id == activity_id)
-    activity_db = session.exec(q).one()
-    if activity_db.owner_id != current_user_id.id:
-        return HTTPException(status_code=401, detail="Not authorized: User doesn't own activity")
-    activity_db.sqlmodel_update(activity_update.model_dump(exclude_unset=True))
-    session.add(activity_db)
+    model_helpers.check_activity_owner(activity_id, current_user_id.id, session)
+    values = activity_update.model_dump(exclude_unset=True)
+    values["last_modified"] = datetime.now()
+    q = update(model.ActivityTable).where(
+        model.ActivityTable.activity_id == activity_id).values(**values).returning(
+            *model_helpers.ACTIVITY_BASE_COLUMNS)
+    row = session.execute(q).one_or_none()
+    if row is None:
+        # Deleted after the ownership check.
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Activity not found")
     session.commit()
-    session.refresh(activity_db)
-    return activity_db
+    return model.ActivityBase.model_validate(row._mapping)
 
 @app_obj.delete("/activity/{activity_id}")
-async def delete_activity(
+def delete_activity(
     *,
     session: Session = Depends(model_helpers.get_db_session),
     current_user_id: model.UserId = Depends(auth_handler.get_current_user_id),
     activity_id: str):
     """Deletes an activity owned by the current user."""
-    activity_db = session.exec(
-        select(model.ActivityTable).where(model.ActivityTable.activity_id == activity_id)
-    ).first()
-
-    if not activity_db:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Activity not found")
-
-    if activity_db.owner_id != current_user_id.id:
-        # Use 403 Forbidden as the user is authenticated but not authorized for this resource
-        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not authorized: User doesn't own activity")
-
-    session.delete(activity_db)
+    model_helpers.check_activity_owner(activity_id, current_user_id.id, session)
+    session.execute(DELETE_ACTIVITY_STMT, {"activity_id": activity_id})
     session.commit()
 
     # Return No Content response explicitly for DELETE success
     return Response(status_code=200)
 
-@app_obj.post("/user/signup", tags=["user"])
-async def create_user(
+@app_obj.post("/user/signup", response_model=model.Token, tags=["user"])
+def create_user(
     *,
     session: Session = Depends(model_helpers.get_db_session),
     user: model.UserCreate = Body(...)):
@@ -254,7 +324,7 @@ async def create_user(
           user's information.
 
     Returns:
-        A `model.Token` object containing the access token and token type
+        The access token and token type, in the shape of `model.Token`,
         upon successful registration.
     """
     db_user = model.User.model_validate(user)
@@ -262,7 +332,4 @@ async def create_user(
     db_user.password = crypto.get_password_hash(db_user.password)
     session.add(db_user)
     session.commit()
-    session.refresh(db_user)
-    return model.Token(
-        access_token=auth_handler.create_access_token(db_user),
-        token_type="bearer")
+    return token_response(auth_handler.create_access_token(db_user))
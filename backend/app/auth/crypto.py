@@ -3,6 +3,7 @@
 
 import base64
 import os
+import time
 
 from passlib.context import CryptContext
 
@@ -53,3 +54,29 @@ def generate_random_base64_string(length: int):
 
     # Remove trailing newline character (optional)
     return encoded_string.rstrip("\n")
+
+
+# Crockford's base32 alphabet, in ascending ASCII order.
+CROCKFORD_BASE32 = "0123456789ABCDEFGHJKMNPQRSTVWXYZ"
+
+
+def generate_ulid(timestamp_ms: int = None):
+    """Generates a ULID: a 48-bit millisecond timestamp followed by 80 random bits.
+
+    The result is a 26 character Crockford base32 string, so ids created
+    later sort after earlier ones both lexicographically and in the DB.
+
+    Args:
+        timestamp_ms: Milliseconds since the epoch. Defaults to the current time.
+
+    Returns:
+        The ULID as a string.
+    """
+    if timestamp_ms is None:
+        timestamp_ms = time.time_ns() // 1_000_000
+    value = (timestamp_ms << 80) | int.from_bytes(os.urandom(10), "big")
+    chars = []
+    for _ in range(26):
+        chars.append(CROCKFORD_BASE32[value & 0x1F])
+        value >>= 5
+    return "".join(reversed(chars))
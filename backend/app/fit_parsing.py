@@ -5,6 +5,10 @@ import os
 
 import subprocess
 import sys
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import pandas as pd
 import pyarrow.ipc as pa_ipc
 import time
@@ -15,18 +19,59 @@ import numpy as np
 from absl import logging
 
 
+# Number of worker processes used to run fitparse, which is also the number
+# of uploads parsed concurrently; further uploads wait for a free worker.
+# Defaults to the CPU count. 0 parses in the calling thread.
+FIT_PARSE_PROCESSES = int(os.getenv("FIT_PARSE_PROCESSES", str(os.cpu_count() or 1)))
+
+process_pool = None
+process_pool_lock = threading.Lock()
+
+
+def get_process_pool():
+    """Returns the process pool used for fitparse, creating it on first use.
+
+    Workers are spawned rather than forked, since the API process runs
+    other threads (request handlers, DB pool) when the pool is created.
+    """
+    global process_pool
+    with process_pool_lock:
+        if process_pool is None:
+            process_pool = ProcessPoolExecutor(
+                max_workers=FIT_PARSE_PROCESSES,
+                mp_context=multiprocessing.get_context("spawn"))
+        return process_pool
+
+
+def reset_process_pool(pool: ProcessPoolExecutor):
+    """Drops `pool` so the next call to `get_process_pool` creates a new one."""
+    global process_pool
+    with process_pool_lock:
+        if process_pool is pool:
+            process_pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def pool_extract_data(stream: bytes):
+    """Runs `fitparse_extract_data` in the process pool.
+
+    If a worker died (e.g. out of memory on a huge file), the pool is broken
+    for good, so it is replaced before the error is raised to the caller.
+    """
+    pool = get_process_pool()
+    try:
+        return pool.submit(fitparse_extract_data, stream).result()
+    except BrokenProcessPool:
+        logging.error("fitparse worker process died, recreating the process pool")
+        reset_process_pool(pool)
+        raise
+
+
 def fitparse_extract_data(stream: bytes):
     fitfile = fitparse.FitFile(stream)
-    data = []
-
-    for record in fitfile.messages:
-        if record.name == 'record':
-            row_data = {}
-            for field in record.fields:
-                row_data[field.name] = field.value
-            data.append(row_data)
+    data = [record.get_values() for record in fitfile.get_messages('record')]
 
-    df = pd.DataFrame(data)
+    df = pd.DataFrame.from_records(data)
     if 'position_lat' in df.columns and 'position_long' in df.columns:    
         position_scale = (1 << 32) / 360.0
         df['position_lat'] = df['position_lat'] / position_scale
@@ -132,7 +177,11 @@ def extract_data_to_dataframe(fitfile: bytes):
         return df
     else:
         t1 = time.time()
-        df = fitparse_extract_data(fitfile)
+        if FIT_PARSE_PROCESSES > 0:
+            # fitparse is pure Python, keep it from holding this process' GIL.
+            df = pool_extract_data(fitfile)
+        else:
+            df = fitparse_extract_data(fitfile)
         t2 = time.time()
         logging.info(f"Elapsed time for fitparse: {t2-t1:.4f} seconds")
         return df
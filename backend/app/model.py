@@ -6,6 +6,7 @@ from datetime import datetime
 from typing import Optional, Union, Sequence
 
 from pydantic import BaseModel, EmailStr
+from sqlalchemy import Index
 from sqlmodel import Field, SQLModel
 
 class UserLogin(SQLModel):
@@ -93,6 +94,14 @@ class ActivityTable(ActivityBase, table=True):
     data: bytes = Field(...)
     static_map: Optional[bytes] = Field(...)
 
+# Matches the keyset pagination order used when listing a user's activities.
+# On Postgres the remaining listed columns are included for index-only scans.
+Index("ix_activity_owner_date_id",
+      ActivityTable.owner_id,
+      ActivityTable.date.desc(),
+      ActivityTable.activity_id.desc(),
+      postgresql_include=["name", "distance", "active_time", "elevation_gain", "last_modified"])
+
 class ActivityUpdate(BaseModel):
     name: Optional[str] = None
     date: Optional[datetime] = None
@@ -1,27 +1,66 @@
 import os
 import io
+import math
+import threading
+import time
+from collections import OrderedDict
+import msgpack
 import numpy as np
 import pandas as pd
 from app import model
+import pyarrow as pa
 import pyarrow.feather as feather
-import gpxpy
-import gpxpy.gpx
 
-from typing import Sequence
+from typing import Optional, Sequence
+from xml.sax.saxutils import XMLGenerator
+from xml.sax.xmlreader import AttributesImpl
+from sqlalchemy import bindparam
+from sqlalchemy.engine import make_url
 from sqlmodel import create_engine, Session, select
-from fastapi import HTTPException
+from fastapi import BackgroundTasks, HTTPException, status
 from staticmap import StaticMap, Line
 from fastapi.responses import Response
+from absl import logging
+
+def get_engine_args(db_url: str):
+    """ Returns the `create_engine` keyword arguments for a DB url.
+
+    Pool sizes can be tuned with the DB_POOL_SIZE, DB_MAX_OVERFLOW and
+    DB_POOL_TIMEOUT environment variables.
+    """
+    url = make_url(db_url)
+    engine_args = {"pool_pre_ping": True, "pool_recycle": 3600}
+    if url.get_backend_name() == "sqlite":
+        engine_args["connect_args"] = {"check_same_thread": False}
+        if url.database in (None, "", ":memory:"):
+            # In-memory SQLite uses a single connection per thread, not a queue pool.
+            return engine_args
+    engine_args.update(
+        pool_size=int(os.getenv("DB_POOL_SIZE", "20")),
+        max_overflow=int(os.getenv("DB_MAX_OVERFLOW", "20")),
+        pool_timeout=int(os.getenv("DB_POOL_TIMEOUT", "10")))
+    return engine_args
 
-connect_args = {"check_same_thread": False}
 engine = create_engine(
     os.getenv("DB_URL"),
     echo=True,
-    connect_args=connect_args)
+    **get_engine_args(os.getenv("DB_URL")))
+
+# Columns backing `model.ActivityBase`, so listings never load the blobs.
+ACTIVITY_BASE_COLUMNS = tuple(
+    getattr(model.ActivityTable, name) for name in model.ActivityBase.model_fields)
+
+# Used by `check_activity_owner`; reads the owner column only.
+ACTIVITY_OWNER_STMT = select(model.ActivityTable.owner_id).where(
+    model.ActivityTable.activity_id == bindparam("activity_id"))
 
 def get_db_session():
-    """Returns DB session."""
-    with Session(engine) as session:
+    """Returns DB session.
+
+    Objects are not expired on commit, so handlers can return what they
+    just wrote without another SELECT to reload it.
+    """
+    with Session(engine, expire_on_commit=False) as session:
         yield session
 
 def remove_columns(df: pd.DataFrame, cols: Sequence[str]):
@@ -31,37 +70,49 @@ def remove_columns(df: pd.DataFrame, cols: Sequence[str]):
 def serialize_dataframe(df: pd.DataFrame):
     rem_cols = ['left_right_balance']
     with io.BytesIO() as buffer:
-        remove_columns(df, rem_cols).to_feather(buffer)
+        feather.write_feather(remove_columns(df, rem_cols), buffer, compression="lz4")
         serialized = buffer.getvalue()
     return serialized
 
-def deserialize_dataframe(serialized: bytes):
-    return feather.read_feather(io.BytesIO(serialized))
+def deserialize_dataframe(serialized: bytes, columns: Optional[Sequence[str]] = None):
+    """ Reads a dataframe written by `serialize_dataframe`.
+
+    If `columns` is given, only those columns are decoded; names that are
+    not stored in the dataframe and repeated names are ignored.
+    """
+    if columns is not None:
+        stored = set(pa.ipc.open_file(pa.BufferReader(serialized)).schema.names)
+        columns = list(dict.fromkeys(col for col in columns if col in stored))
+        if not columns:
+            # read_table treats an empty list as "all columns".
+            return pd.DataFrame()
+    return feather.read_table(pa.BufferReader(serialized), columns=columns).to_pandas()
 
 def compute_elevation_gain_intervals(df: pd.DataFrame, tolerance=1.0, min_elev=1.0):
     altitude_series = df.altitude.dropna()
-    altitude = altitude_series.to_list()
-    original_ix = altitude_series.index
-    #print(len(original_ix), len(altitude))
+    # Plain Python lists: much cheaper to index per sample than pandas objects.
+    altitude = altitude_series.to_numpy(dtype=float).tolist()
+    original_ix = altitude_series.index.to_numpy().tolist()
     climbs = []
+    if not altitude:
+        return climbs
     high_ix = low_ix = 0
+    low = high = altitude[0]
     for i, h in enumerate(altitude):
-        if h < altitude[low_ix]:
-            low_ix = i
-        if h > altitude[high_ix]:
-            high_ix = i
-        if h < (altitude[high_ix] - tolerance):
+        if h < low:
+            low_ix, low = i, h
+        if h > high:
+            high_ix, high = i, h
+        if h < (high - tolerance):
             # It means we are going down again
-            climb = model.Climb(
-                from_ix=original_ix[low_ix],
-                to_ix=original_ix[high_ix],
-                elevation=altitude[high_ix] - altitude[low_ix]
-            )
-            #print(low_ix, high_ix, climb)
-            if climb.from_ix < climb.to_ix and climb.elevation > min_elev:
-                climbs.append(climb)
-            low_ix = i
-            high_ix = i
+            if original_ix[low_ix] < original_ix[high_ix] and high - low > min_elev:
+                climbs.append(model.Climb(
+                    from_ix=original_ix[low_ix],
+                    to_ix=original_ix[high_ix],
+                    elevation=high - low
+                ))
+            low_ix = high_ix = i
+            low = high = h
     return climbs
 
 def compute_elevation_gain(df: pd.DataFrame, tolerance: float, min_elev: float):
@@ -77,19 +128,88 @@ def get_activity_map(ride_df: pd.DataFrame, num_samples: int):
     """
     if not 'position_lat' in ride_df.columns or not 'position_long' in ride_df.columns:
         return None
-    df = ride_df.dropna(subset=['position_lat', 'position_long'])
+    lat = ride_df.position_lat.to_numpy(dtype=float)
+    long = ride_df.position_long.to_numpy(dtype=float)
+    valid = ~(np.isnan(lat) | np.isnan(long))
+    lat, long = lat[valid], long[valid]
+    if len(lat) == 0:
+        return None
     w = int(os.getenv("STATIC_MAP_W", "400"))
     h = int(os.getenv("STATIC_MAP_H", "300"))
     m = StaticMap(w, h, 10)
-    lat = subsample_timeseries(df.position_lat, num_samples=num_samples)
-    long = subsample_timeseries(df.position_long, num_samples=num_samples)
-    line = list(zip(long, lat))
+    # Same sample indices for both coordinates, picked on the numpy arrays.
+    indices = np.linspace(0, len(lat) - 1, num_samples).astype(np.int64)
+    line = list(zip(long[indices].tolist(), lat[indices].tolist()))
     m.add_line(Line(line, 'blue', 3))
     image = m.render()
     img_byte_arr = io.BytesIO()
     image.save(img_byte_arr, format='PNG')
     return img_byte_arr.getvalue()
 
+# Activities whose map is queued or being rendered.
+pending_activity_maps = set()
+# activity_id -> (failed renders, time.monotonic() before which not to retry).
+failed_activity_maps = {}
+activity_maps_lock = threading.Lock()
+MAP_RETRY_BASE_SECONDS = 30
+MAP_RETRY_MAX_SECONDS = 3600
+
+def has_gps_points(ride_df: pd.DataFrame):
+    """ Whether the ride has at least one sample with both coordinates.
+    """
+    if not has_gps_data(ride_df):
+        return False
+    return bool((ride_df.position_lat.notna() & ride_df.position_long.notna()).any())
+
+def render_activity_map(activity_id: str):
+    """ Renders and stores the static map of an activity.
+
+    Runs as a background task, so it uses its own DB session. Failures
+    (e.g. map tiles that can't be downloaded) are logged and recorded, and
+    further renders of that activity back off exponentially.
+    """
+    try:
+        with Session(engine, expire_on_commit=False) as session:
+            activity = session.get(model.ActivityTable, activity_id)
+            if activity is None or activity.static_map:
+                return
+            activity_df = get_activity_df(
+                activity, columns=["position_lat", "position_long"])
+            activity.static_map = get_activity_map(ride_df=activity_df, num_samples=200)
+            if activity.static_map:
+                session.add(activity)
+                session.commit()
+        with activity_maps_lock:
+            failed_activity_maps.pop(activity_id, None)
+    except Exception:  # pylint: disable=broad-exception-caught
+        logging.exception(f"Failed to render the map of activity {activity_id}")
+        with activity_maps_lock:
+            failures = failed_activity_maps.get(activity_id, (0, 0))[0] + 1
+            delay = min(MAP_RETRY_BASE_SECONDS * 2 ** (failures - 1), MAP_RETRY_MAX_SECONDS)
+            failed_activity_maps[activity_id] = (failures, time.monotonic() + delay)
+    finally:
+        with activity_maps_lock:
+            pending_activity_maps.discard(activity_id)
+
+def activity_map_retry_after(activity_id: str):
+    """ Seconds until the map of an activity whose render failed may be
+    rendered again, or None if it can be rendered now.
+    """
+    with activity_maps_lock:
+        if activity_id not in failed_activity_maps:
+            return None
+        remaining = failed_activity_maps[activity_id][1] - time.monotonic()
+    return math.ceil(remaining) if remaining > 0 else None
+
+def schedule_activity_map(activity_id: str, background_tasks: BackgroundTasks):
+    """ Queues `render_activity_map` unless the map is already pending.
+    """
+    with activity_maps_lock:
+        if activity_id in pending_activity_maps:
+            return
+        pending_activity_maps.add(activity_id)
+    background_tasks.add_task(render_activity_map, activity_id)
+
 def elev_summary(ride_df: pd.DataFrame, num_samples: int):
     n = min(len(ride_df.altitude), num_samples)
     summary = model.ElevationSummary(
@@ -109,23 +229,64 @@ def compute_activity_summary(ride_df: pd.DataFrame, num_samples: int = 200):
         total_elapsed_time=(ride_df['timestamp'].iloc[-1] - ride_df['timestamp'][0]).seconds,
         active_time=total_time,
         elevation_gain=elevation_gain,
-        average_speed=ride_df['speed'].mean() * 3.6  # From m/s to km/h
+        average_speed=np.nanmean(ride_df['speed'].to_numpy(dtype=float)) * 3.6  # From m/s to km/h
     )
     if 'power' in ride_df.columns:
-        work = ride_df.power.sum()
-        quantiles = ride_df.power.quantile(np.arange(0, 101)/100)
+        power = ride_df.power.to_numpy(dtype=float)
+        work = np.nansum(power)
+        quantiles = np.nanquantile(power, np.arange(0, 101)/100)
         summary.power_summary = model.PowerSummary(
             average_power = work / total_time,
-            median_power = quantiles.iloc[50],
+            median_power = quantiles[50],
             total_work = work / 1000,  # to KJ instad of Joules
-            quantiles = quantiles.to_list()
+            quantiles = quantiles.tolist()
         )
     if 'altitude' in ride_df.columns:
         summary.elev_summary = elev_summary(ride_df, num_samples)
     return summary
 
-def get_activity_raw_df(activity_db: model.ActivityTable):
-    return deserialize_dataframe(activity_db.data)
+# msgpack extension type code used for raw numpy arrays.
+NDARRAY_EXT_CODE = 1
+
+def pack_ndarray(arr: np.ndarray):
+    """ Wraps a numpy array in a msgpack ExtType.
+
+    The payload is a msgpack `[dtype, shape]` header followed by the raw
+    array bytes, so numeric columns are sent as one binary blob instead
+    of one msgpack float per sample. Decode it with `ndarray_ext_hook`.
+    """
+    arr = np.ascontiguousarray(arr)
+    header = msgpack.packb([arr.dtype.str, list(arr.shape)])
+    return msgpack.ExtType(NDARRAY_EXT_CODE, header + arr.tobytes())
+
+def ndarray_ext_hook(code: int, data: bytes):
+    """ msgpack `ext_hook` that rebuilds arrays packed with `pack_ndarray`.
+    """
+    if code != NDARRAY_EXT_CODE:
+        return msgpack.ExtType(code, data)
+    unpacker = msgpack.Unpacker()
+    unpacker.feed(data)
+    dtype, shape = unpacker.unpack()
+    return np.frombuffer(data, dtype=dtype, offset=unpacker.tell()).reshape(shape)
+
+def check_activity_owner(activity_id: str, user_id: int, session: Session):
+    """ Raises an HTTPException unless `user_id` owns the activity.
+
+    Only the owner_id column is read, never the activity blobs.
+    """
+    owner_id = session.exec(ACTIVITY_OWNER_STMT, params={"activity_id": activity_id}).one_or_none()
+    if owner_id is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Activity not found")
+    if owner_id != user_id:
+        # Use 403 Forbidden as the user is authenticated but not authorized for this resource
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Not authorized: User doesn't own activity")
+
+def get_activity_raw_df(
+        activity_db: model.ActivityTable,
+        columns: Optional[Sequence[str]] = None):
+    return deserialize_dataframe(activity_db.data, columns=columns)
 
 def has_gps_data(activity_df):
     return 'position_lat' in activity_df.columns and \
@@ -152,57 +313,106 @@ def fetch_activity(activity_id: str, session: Session):
         raise HTTPException(status_code=404, detail="Activity not found")
     return activity
 
-def get_activity_df(activity: model.ActivityTable):
-    activity_df = get_activity_raw_df(activity)
-    activity_df.timestamp = activity_df.timestamp.apply(lambda x: x.timestamp() if x else None)
-    return activity_df
+# In-process LRU of decoded activity dataframes, keyed by
+# (activity_id, last_modified, columns) so edits invalidate old entries.
+activity_df_cache = OrderedDict()
+activity_df_cache_lock = threading.Lock()
+ACTIVITY_DF_CACHE_SIZE = int(os.getenv("ACTIVITY_DF_CACHE_SIZE", "128"))
 
-def fetch_activity_df(activity_id: str, session: Session):
+def clear_activity_df_cache():
+    with activity_df_cache_lock:
+        activity_df_cache.clear()
+
+def get_activity_df(
+        activity: model.ActivityTable,
+        columns: Optional[Sequence[str]] = None):
+    """ Returns the activity dataframe with timestamps in seconds.
+
+    Decoded dataframes are cached, callers get a shallow copy.
+    """
+    if columns is not None:
+        columns = tuple(dict.fromkeys(columns))
+    key = (activity.activity_id, activity.last_modified, columns)
+    with activity_df_cache_lock:
+        activity_df = activity_df_cache.get(key)
+        if activity_df is not None:
+            activity_df_cache.move_to_end(key)
+            return activity_df.copy(deep=False)
+    activity_df = get_activity_raw_df(activity, columns=columns)
+    if 'timestamp' in activity_df.columns:
+        activity_df.timestamp = activity_df.timestamp.apply(lambda x: x.timestamp() if x else None)
+    with activity_df_cache_lock:
+        activity_df_cache[key] = activity_df
+        while len(activity_df_cache) > ACTIVITY_DF_CACHE_SIZE:
+            activity_df_cache.popitem(last=False)
+    return activity_df.copy(deep=False)
+
+def fetch_activity_df(
+        activity_id: str,
+        session: Session,
+        columns: Optional[Sequence[str]] = None):
     activity = fetch_activity(activity_id, session)
-    return get_activity_df(activity)
+    return get_activity_df(activity, columns=columns)
+
+GPX_ATTRIBUTES = {
+    "xmlns": "http://www.topografix.com/GPX/1/1",
+    "xmlns:xsi": "http://www.w3.org/2001/XMLSchema-instance",
+    "xsi:schemaLocation": (
+        "http://www.topografix.com/GPX/1/1 http://www.topografix.com/GPX/1/1/gpx.xsd"),
+    "version": "1.1",
+    "creator": "fit_analyse",
+}
 
-def get_activity_gpx(ride_df: pd.DataFrame):
+def get_activity_gpx(ride_df: pd.DataFrame, chunk_size: int = 512):
     """
-    Generates a GPX file content from a DataFrame containing ride data using gpxpy.
+    Generates a GPX file content from a DataFrame containing ride data.
+
+    The GPS check runs eagerly, so a missing route still becomes a 404
+    before any content is streamed.
 
     Args:
-        ride_df: DataFrame with 'timestamp', 'position_lat', and 'position_long' columns.
+        ride_df: DataFrame with 'position_lat' and 'position_long' columns.
+        chunk_size: Number of track points written per chunk.
 
     Returns:
-        GPX file content as a string.
+        An async iterator over the GPX file content, as bytes.
     """
     if not has_gps_data(ride_df):
         raise HTTPException(status_code=404, detail="GPS data not available")
 
     # Filter out rows with missing lat/long
-    valid_rows = ride_df.dropna(subset=['position_lat', 'position_long'])
-
-    if valid_rows.empty:
-        gpx = gpxpy.gpx.GPX()
-        return gpx.to_xml()
-
-    gpx = gpxpy.gpx.GPX()
-    gpx_track = gpxpy.gpx.GPXTrack()
-    gpx.tracks.append(gpx_track)
-    gpx_segment = gpxpy.gpx.GPXTrackSegment()
-    gpx_track.segments.append(gpx_segment)
-
-    lat = valid_rows['position_lat'].to_numpy()
-    long = valid_rows['position_long'].to_numpy()
-    # if 'altitude' in valid_rows.columns:
-    #     alt = valid_rows['altitude'].to_numpy()
-    #     has_alt = ~np.isnan(alt)
-    #     print(has_alt.shape)
-    # else:
-    #     alt = None
-
-    for index in range(len(valid_rows)):
-        gpx_point = gpxpy.gpx.GPXTrackPoint(
-            latitude=lat[index],
-            longitude=long[index]
-        )
-        # if alt and has_alt[index]:
-        #     gpx_point.elevation = alt[index]
-        gpx_segment.points.append(gpx_point)
+    lat = ride_df['position_lat'].to_numpy(dtype=float)
+    long = ride_df['position_long'].to_numpy(dtype=float)
+    valid = ~(np.isnan(lat) | np.isnan(long))
+    return generate_gpx(lat[valid].tolist(), long[valid].tolist(), chunk_size)
+
+async def generate_gpx(lat: Sequence[float], long: Sequence[float], chunk_size: int):
+    """ Yields a GPX track with the given points, `chunk_size` points at a time.
+    """
+    buffer = io.BytesIO()
+    xml = XMLGenerator(buffer, encoding="UTF-8", short_empty_elements=True)
+
+    def drain():
+        chunk = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        return chunk
 
-    return gpx.to_xml()
+    xml.startDocument()
+    xml.startElement("gpx", AttributesImpl(GPX_ATTRIBUTES))
+    if lat:
+        xml.startElement("trk", AttributesImpl({}))
+        xml.startElement("trkseg", AttributesImpl({}))
+        for start in range(0, len(lat), chunk_size):
+            for point_lat, point_long in zip(
+                    lat[start:start + chunk_size], long[start:start + chunk_size]):
+                xml.startElement(
+                    "trkpt",
+                    AttributesImpl({"lat": repr(point_lat), "lon": repr(point_long)}))
+                xml.endElement("trkpt")
+            yield drain()
+        xml.endElement("trkseg")
+        xml.endElement("trk")
+    xml.endElement("gpx")
+    xml.endDocument()
+    yield drain()
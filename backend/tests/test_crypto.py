@@ -0,0 +1,17 @@
+import unittest
+from app.auth import crypto
+
+class TestCrypto(unittest.TestCase):
+
+    def test_generate_ulid(self):
+        ulid = crypto.generate_ulid()
+        self.assertEqual(len(ulid), 26)
+        self.assertTrue(set(ulid) <= set(crypto.CROCKFORD_BASE32))
+
+    def test_generate_ulid_sorted_by_time(self):
+        self.assertEqual(crypto.generate_ulid(0)[:10], "0000000000")
+        ids = [crypto.generate_ulid(t) for t in (1000, 1001, 2**40)]
+        self.assertListEqual(ids, sorted(ids))
+
+if __name__ == '__main__':
+    unittest.main()
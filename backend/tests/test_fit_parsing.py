@@ -0,0 +1,33 @@
+import unittest
+from concurrent.futures.process import BrokenProcessPool
+from unittest.mock import patch
+
+import fitparse
+from app import fit_parsing
+
+class TestFitParsing(unittest.TestCase):
+
+    def tearDown(self):
+        if fit_parsing.process_pool is not None:
+            fit_parsing.reset_process_pool(fit_parsing.process_pool)
+
+    def test_pool_extract_data_raises_parse_errors(self):
+        # Runs in a real spawned worker, the error is sent back to the caller.
+        with self.assertRaises(fitparse.FitParseError):
+            fit_parsing.pool_extract_data(b'not a fit file')
+        self.assertIsNotNone(fit_parsing.process_pool)
+
+    @patch('app.fit_parsing.ProcessPoolExecutor')
+    def test_pool_extract_data_recreates_broken_pool(self, MockExecutor):
+        broken_pool = MockExecutor.return_value
+        broken_pool.submit.return_value.result.side_effect = BrokenProcessPool()
+        with self.assertRaises(BrokenProcessPool):
+            fit_parsing.pool_extract_data(b'data')
+        self.assertIsNone(fit_parsing.process_pool)
+        broken_pool.shutdown.assert_called_once()
+
+        fit_parsing.get_process_pool()
+        self.assertEqual(MockExecutor.call_count, 2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,14 +1,34 @@
+import asyncio
 import unittest
+import msgpack
+import numpy as np
 import pandas as pd
 from app import model
 from app import model_helpers
-from unittest.mock import patch
+from unittest.mock import MagicMock, patch
 import io
+import xml.etree.ElementTree as ET
 import pyarrow.feather as feather
 from datetime import datetime
 
 class TestModelHelpers(unittest.TestCase):
 
+    def setUp(self):
+        model_helpers.clear_activity_df_cache()
+
+    def test_get_engine_args(self):
+        args = model_helpers.get_engine_args("postgresql://user@localhost/db")
+        self.assertTrue(args["pool_pre_ping"])
+        self.assertEqual(args["pool_size"], 20)
+        self.assertNotIn("connect_args", args)
+
+        args = model_helpers.get_engine_args("sqlite:///database.db")
+        self.assertEqual(args["connect_args"], {"check_same_thread": False})
+        self.assertIn("max_overflow", args)
+
+        args = model_helpers.get_engine_args("sqlite://")
+        self.assertNotIn("max_overflow", args)
+
     def test_remove_columns(self):
         df = pd.DataFrame({'col1': [1, 2], 'col2': [3, 4], 'col3': [5, 6]})
         result_df = model_helpers.remove_columns(df, ['col2', 'col3'])
@@ -25,6 +45,24 @@ class TestModelHelpers(unittest.TestCase):
 
         pd.testing.assert_frame_equal(deserialized_df, df[['col1', 'col2', 'col3']])
 
+    def test_pack_ndarray(self):
+        arr = np.array([1.5, np.nan, 3.0])
+        packed = msgpack.packb({'power': model_helpers.pack_ndarray(arr)})
+        unpacked = msgpack.unpackb(packed, ext_hook=model_helpers.ndarray_ext_hook)
+        np.testing.assert_array_equal(unpacked['power'], arr)
+        self.assertEqual(unpacked['power'].dtype, np.float64)
+
+    def test_deserialize_dataframe_columns(self):
+        df = pd.DataFrame({'col1': [1, 2], 'col2': [3.0, 4.0], 'col3': [True, False]})
+        serialized = model_helpers.serialize_dataframe(df)
+        deserialized_df = model_helpers.deserialize_dataframe(
+            serialized, columns=['col3', 'col1', 'missing', 'col3'])
+        pd.testing.assert_frame_equal(deserialized_df, df[['col3', 'col1']])
+
+        deserialized_df = model_helpers.deserialize_dataframe(serialized, columns=['missing'])
+        self.assertTrue(deserialized_df.empty)
+        self.assertListEqual(list(deserialized_df.columns), [])
+
     def test_compute_elevation_gain_intervals(self):
         df = pd.DataFrame({
             'altitude': [10, 12, 15, 14, 16, 13, 17, 18, 16]
@@ -64,6 +102,51 @@ class TestModelHelpers(unittest.TestCase):
         model_helpers.get_activity_map(ride_df, num_samples=2)
         MockStaticMap.assert_called_once()
 
+    @patch('app.model_helpers.StaticMap')
+    def test_get_activity_map_no_gps(self, MockStaticMap):
+        ride_df = pd.DataFrame({
+            'position_lat': [float('nan')] * 3,
+            'position_long': [1.0, 2.0, 3.0]
+        })
+        self.assertIsNone(model_helpers.get_activity_map(ride_df, num_samples=2))
+        MockStaticMap.assert_not_called()
+
+    def test_has_gps_points(self):
+        self.assertTrue(model_helpers.has_gps_points(pd.DataFrame({
+            'position_lat': [float('nan'), 2.0],
+            'position_long': [6.0, 7.0]
+        })))
+        self.assertFalse(model_helpers.has_gps_points(pd.DataFrame({
+            'position_lat': [1.0, float('nan')],
+            'position_long': [float('nan'), 7.0]
+        })))
+        self.assertFalse(model_helpers.has_gps_points(pd.DataFrame({'power': [1, 2]})))
+
+    def test_schedule_activity_map(self):
+        background_tasks = MagicMock()
+        model_helpers.schedule_activity_map("some_id", background_tasks)
+        model_helpers.schedule_activity_map("some_id", background_tasks)
+        background_tasks.add_task.assert_called_once_with(
+            model_helpers.render_activity_map, "some_id")
+        model_helpers.pending_activity_maps.discard("some_id")
+
+    @patch('app.model_helpers.Session')
+    def test_render_activity_map_failure(self, MockSession):
+        MockSession.return_value.__enter__.return_value.get.side_effect = RuntimeError(
+            "could not download 4 tiles")
+        model_helpers.pending_activity_maps.add("some_id")
+        model_helpers.render_activity_map("some_id")
+        self.assertNotIn("some_id", model_helpers.pending_activity_maps)
+        retry_after = model_helpers.activity_map_retry_after("some_id")
+        self.assertEqual(retry_after, model_helpers.MAP_RETRY_BASE_SECONDS)
+
+        # A second failure doubles the backoff.
+        model_helpers.render_activity_map("some_id")
+        self.assertEqual(model_helpers.activity_map_retry_after("some_id"),
+                         2 * model_helpers.MAP_RETRY_BASE_SECONDS)
+        model_helpers.failed_activity_maps.pop("some_id")
+        self.assertIsNone(model_helpers.activity_map_retry_after("some_id"))
+
     def test_compute_activity_summary(self):
         df = pd.DataFrame({
             'distance': [0, 100, 200, 300, 400, 500],
@@ -189,6 +272,21 @@ class TestModelHelpers(unittest.TestCase):
             model_helpers.fetch_activity("some_id", mock_session)
         self.assertEqual(context.exception.status_code, 404)
 
+    @patch('app.model_helpers.Session')
+    def test_check_activity_owner(self, MockSession):
+        mock_session = MockSession.return_value
+        mock_session.exec.return_value.one_or_none.return_value = 1
+        model_helpers.check_activity_owner("some_id", 1, mock_session)
+
+        with self.assertRaises(Exception) as context:
+            model_helpers.check_activity_owner("some_id", 2, mock_session)
+        self.assertEqual(context.exception.status_code, 403)
+
+        mock_session.exec.return_value.one_or_none.return_value = None
+        with self.assertRaises(Exception) as context:
+            model_helpers.check_activity_owner("some_id", 1, mock_session)
+        self.assertEqual(context.exception.status_code, 404)
+
     def test_get_activity_df(self):
       # Create a sample DataFrame
       sample_df = pd.DataFrame({
@@ -216,6 +314,12 @@ class TestModelHelpers(unittest.TestCase):
       self.assertListEqual(list(df.columns), ["col1", "col2", "timestamp"])
       self.assertAlmostEqual(df.timestamp[0], 1672567200.0)
 
+      # A second call is served from the cache without decoding the data.
+      with patch('app.model_helpers.get_activity_raw_df') as mock_raw_df:
+          cached_df = model_helpers.get_activity_df(mock_activity_table)
+          mock_raw_df.assert_not_called()
+      pd.testing.assert_frame_equal(cached_df, df)
+
     @patch('app.model_helpers.fetch_activity')
     def test_fetch_activity_df(self, mock_fetch_activity):
         # Create a sample DataFrame
@@ -244,5 +348,27 @@ class TestModelHelpers(unittest.TestCase):
         df = model_helpers.fetch_activity_df("some_id", "some_session")
         self.assertListEqual(list(df.columns), ["col1", "col2", "timestamp"])
 
+    def test_get_activity_gpx(self):
+        ride_df = pd.DataFrame({
+            'position_lat': [45.0, float('nan'), 45.2, 45.3],
+            'position_long': [7.0, 7.1, 7.2, 7.3]
+        })
+
+        async def collect(chunks):
+            return [chunk async for chunk in chunks]
+
+        chunks = asyncio.run(collect(model_helpers.get_activity_gpx(ride_df, chunk_size=2)))
+        self.assertEqual(len(chunks), 3)
+        root = ET.fromstring(b''.join(chunks))
+        ns = {'gpx': 'http://www.topografix.com/GPX/1/1'}
+        points = root.findall('gpx:trk/gpx:trkseg/gpx:trkpt', ns)
+        self.assertListEqual([p.get('lat') for p in points], ['45.0', '45.2', '45.3'])
+        self.assertListEqual([p.get('lon') for p in points], ['7.0', '7.2', '7.3'])
+
+    def test_get_activity_gpx_no_gps(self):
+        with self.assertRaises(Exception) as context:
+            model_helpers.get_activity_gpx(pd.DataFrame({'power': [1, 2]}))
+        self.assertEqual(context.exception.status_code, 404)
+
 if __name__ == '__main__':
     unittest.main()
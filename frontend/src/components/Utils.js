@@ -1,3 +1,7 @@
+import { useState, useEffect } from "react";
+
+// Give up on a pending map after this many 202 responses.
+const MAX_MAP_POLLS = 30;
 
 export function ParseBackendResponse(response, navigate) {
   if (!response.ok) {
@@ -28,4 +32,65 @@ export function getElapsedTime(seconds) {
     `${hours.toString().padStart(2, '0')}`,
     `${min.toString().padStart(2, '0')}`,
     `${sec.toString().padStart(2, '0')}`].join(":")
-}
\ No newline at end of file
+}
+
+// Loads the static map of an activity. The backend renders maps in the
+// background and answers 202 with Retry-After until the PNG is ready, so
+// the map is fetched (and polled) here instead of through a plain <img src>.
+// Returns [mapUrl, mapError]; mapUrl stays null while the map is pending.
+export function useActivityMap(activityId) {
+  const [mapUrl, setMapUrl] = useState(null);
+  const [mapError, setMapError] = useState(false);
+
+  useEffect(() => {
+    setMapUrl(null);
+    setMapError(false);
+    if (!activityId) {
+      return;
+    }
+    const url = `${import.meta.env.VITE_BACKEND_URL}/activity_map/${activityId}`;
+    let cancelled = false;
+    let timer = null;
+    let objectUrl = null;
+
+    const load = (polls) => {
+      fetch(url)
+        .then((response) => {
+          if (cancelled) {
+            return;
+          }
+          if (response.status == 202 && polls < MAX_MAP_POLLS) {
+            const retryAfter = Number(response.headers.get("Retry-After")) || 2;
+            timer = setTimeout(() => load(polls + 1), retryAfter * 1000);
+            return;
+          }
+          if (response.status != 200) {
+            setMapError(true);
+            return;
+          }
+          return response.blob().then((blob) => {
+            if (!cancelled) {
+              objectUrl = URL.createObjectURL(blob);
+              setMapUrl(objectUrl);
+            }
+          });
+        })
+        .catch(() => {
+          if (!cancelled) {
+            setMapError(true);
+          }
+        });
+    };
+    load(0);
+
+    return () => {
+      cancelled = true;
+      clearTimeout(timer);
+      if (objectUrl) {
+        URL.revokeObjectURL(objectUrl);
+      }
+    };
+  }, [activityId]);
+
+  return [mapUrl, mapError];
+}
@@ -6,7 +6,7 @@ import { FaPencil, FaDownload, FaTrash } from "react-icons/fa6";
 import PowerCard from './power/PowerCard'
 import { ElevCard } from './activity/ElevationCard';
 import {Metric, MetricBox} from './MetricComponents'
-import {getElapsedTime, GetToken} from './Utils';
+import {getElapsedTime, GetToken, useActivityMap} from './Utils';
 import loadingImg from '../assets/loading.gif';
 
 function ViewActivity() {
@@ -20,6 +20,7 @@ function ViewActivity() {
 
   const token = GetToken();
   const navigate = useNavigate();
+  const [mapImageUrl, mapImageError] = useActivityMap(activity?.has_gps_data ? id : null);
 
   useEffect(() => {
     setIsLoadingMainActivity(true);
@@ -200,14 +201,14 @@ function ViewActivity() {
           </div>
           {activity?.has_gps_data && (
             <div>
-              <a href={`../map/${activity.activity_base.activity_id}`}>
-                <img
-                  src={`${import.meta.env.VITE_BACKEND_URL}/activity_map/${
-                    activity.activity_base.activity_id
-                  }`}
-                  alt="Activity Map"
-                />
-              </a>
+              {!mapImageError && (
+                <a href={`../map/${activity.activity_base.activity_id}`}>
+                  <img
+                    src={mapImageUrl || loadingImg}
+                    alt="Activity Map"
+                  />
+                </a>
+              )}
               <div className="flex flex-row items-center">
                 GPX File:
                 <a
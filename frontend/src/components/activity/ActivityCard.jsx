@@ -1,20 +1,9 @@
-import { getElapsedTime } from "../Utils";
+import { getElapsedTime, useActivityMap } from "../Utils";
 import {Metric, MetricBox} from '../MetricComponents'
-import { useState, useEffect } from 'react';
+import loadingImg from '../../assets/loading.gif';
 
 export function ActivityCard({activity}) {
-    const [mapImageUrl, setMapImageUrl] = useState(null);
-    const [mapImageError, setMapImageError] = useState(false);
-
-    useEffect(() => {
-        const imageUrl = `${import.meta.env.VITE_BACKEND_URL}/activity_map/${activity.activity_id}`;
-        setMapImageUrl(imageUrl);
-        setMapImageError(false); // Reset error state on new activity
-    }, [activity.activity_id]);
-
-    const handleImageError = () => {
-        setMapImageError(true);
-    };
+    const [mapImageUrl, mapImageError] = useActivityMap(activity.activity_id);
 
     return (
       <div className="card-container">
@@ -30,15 +19,16 @@ export function ActivityCard({activity}) {
           <div className="no-map-image">
             <p>Indoor ride</p>
           </div>
-        ) : (
+        ) : mapImageUrl ? (
           <a href={`./map/${activity.activity_id}`}>
             <img
               src={mapImageUrl}
-              onError={handleImageError}
               alt={`Map for ${activity.name}`}
               style={{ width: "100%", height: "auto" }}
             />
           </a>
+        ) : (
+          <img src={loadingImg} alt="Loading map..." />
         )}
       </div>
     );